@@ -1,4 +1,5 @@
 import argparse
+import math
 
 import numpy as np
 import pandas as pd
@@ -51,7 +52,7 @@ class Time2Vector(Layer):
 
     def call(self, x):
         '''Calculate linear and periodic time features'''
-        x = tf.math.reduce_mean(x[:,:,:3], axis=-1) 
+        x = tf.einsum('bsc,c->bs', x[:,:,:3], tf.constant([1/3, 1/3, 1/3], dtype=x.dtype)) # Mean of the first 3 columns
         time_linear = self.weights_linear * x + self.bias_linear # Linear time feature
         time_linear = tf.expand_dims(time_linear, axis=-1) # Add dimension (batch, seq_len, 1)
         
@@ -66,71 +67,84 @@ class Time2Vector(Layer):
 
 #############################################################################
 
-class SingleAttention(Layer):
-    def __init__(self, d_k, d_v):
-        super(SingleAttention, self).__init__()
+class MultiAttention(Layer):
+    def __init__(self, d_k, d_v, n_heads):
+        super(MultiAttention, self).__init__()
         self.d_k = d_k
         self.d_v = d_v
+        self.n_heads = n_heads
+        self._inv_sqrt_dk = 1.0 / math.sqrt(d_k)
+
+    def head_initializer(self, in_dim, depth):
+        '''Glorot uniform of one head's (in_dim, depth) kernel, glorot_uniform on the stacked kernel would count n_heads in both fans'''
+        limit = math.sqrt(6 / (in_dim + depth))
+        return tf.keras.initializers.RandomUniform(-limit, limit)
 
     def build(self, input_shape):
-        self.query = Dense(
-            self.d_k, 
-            input_shape=input_shape, 
-            kernel_initializer='glorot_uniform', 
-            bias_initializer='glorot_uniform'
+        # Q, K and V weights of all heads stacked, kernel shape = (n_heads, 6, d_k)
+        in_dim = input_shape[0][-1]
+        self.query_kernel = self.add_weight(
+            name='query_kernel',
+            shape=(self.n_heads, in_dim, self.d_k),
+            initializer=self.head_initializer(in_dim, self.d_k),
+            trainable=True
         )
-        
-        self.key = Dense(
-            self.d_k, 
-            input_shape=input_shape, 
-            kernel_initializer='glorot_uniform', 
-            bias_initializer='glorot_uniform'
+
+        self.query_bias = self.add_weight(
+            name='query_bias',
+            shape=(self.n_heads, 1, self.d_k),
+            initializer='zeros',
+            trainable=True
         )
-        
-        self.value = Dense(
-            self.d_v, 
+
+        self.key_kernel = self.add_weight(
+            name='key_kernel',
+            shape=(self.n_heads, in_dim, self.d_k),
+            initializer=self.head_initializer(in_dim, self.d_k),
+            trainable=True
+        )
+
+        self.key_bias = self.add_weight(
+            name='key_bias',
+            shape=(self.n_heads, 1, self.d_k),
+            initializer='zeros',
+            trainable=True
+        )
+
+        self.value_kernel = self.add_weight(
+            name='value_kernel',
+            shape=(self.n_heads, in_dim, self.d_v),
+            initializer=self.head_initializer(in_dim, self.d_v),
+            trainable=True
+        )
+
+        self.value_bias = self.add_weight(
+            name='value_bias',
+            shape=(self.n_heads, 1, self.d_v),
+            initializer='zeros',
+            trainable=True
+        )
+
+        # input_shape[0]=(batch, seq_len, 6), input_shape[0][-1]=6
+        self.linear = Dense(
+            input_shape[0][-1], 
             input_shape=input_shape, 
-            kernel_initializer='glorot_uniform', 
-            bias_initializer='glorot_uniform'
+            kernel_initializer='glorot_uniform'
         )
 
     def call(self, inputs): # inputs = (in_seq, in_seq, in_seq)
-        q = self.query(inputs[0])
-        k = self.key(inputs[1])
+        # Project every head at once, shape = (batch, n_heads, seq_len, d_k)
+        q = tf.einsum('bsd,hde->bhse', inputs[0], self.query_kernel) + self.query_bias
+        k = tf.einsum('bsd,hde->bhse', inputs[1], self.key_kernel) + self.key_bias
+        v = tf.einsum('bsd,hde->bhse', inputs[2], self.value_kernel) + self.value_bias
 
-        attn_weights = tf.matmul(q, k, transpose_b=True)
-        attn_weights = tf.map_fn(lambda x: x/np.sqrt(self.d_k), attn_weights)
+        attn_weights = tf.einsum('bhqd,bhkd->bhqk', q, k)
+        attn_weights = attn_weights * tf.cast(self._inv_sqrt_dk, attn_weights.dtype) # Scale by 1/sqrt(d_k)
         attn_weights = tf.nn.softmax(attn_weights, axis=-1)
-        
-        v = self.value(inputs[2])
-        attn_out = tf.matmul(attn_weights, v)
-        return attn_out
-
-#############################################################################
+        attn_out = tf.einsum('bhqk,bhkd->bqhd', attn_weights, v)
 
-class MultiAttention(Layer):
-    def __init__(self, d_k, d_v, n_heads):
-        super(MultiAttention, self).__init__()
-        self.d_k = d_k
-        self.d_v = d_v
-        self.n_heads = n_heads
-        self.attn_heads = list()
-
-    def build(self, input_shape):
-        for n in range(self.n_heads):
-            self.attn_heads.append(SingleAttention(self.d_k, self.d_v))  
-            
-            # input_shape[0]=(batch, seq_len, 6), input_shape[0][-1]=6
-            self.linear = Dense(
-                input_shape[0][-1], 
-                input_shape=input_shape, 
-                kernel_initializer='glorot_uniform', 
-                bias_initializer='glorot_uniform'
-            )
-
-    def call(self, inputs):
-        attn = [self.attn_heads[i](inputs) for i in range(self.n_heads)]
-        concat_attn = tf.concat(attn, axis=-1)
+        # Concatenate heads, shape = (batch, seq_len, n_heads * d_v)
+        concat_attn = tf.reshape(attn_out, (tf.shape(attn_out)[0], tf.shape(attn_out)[1], self.n_heads * self.d_v))
         multi_linear = self.linear(concat_attn)
         return multi_linear
 
@@ -143,29 +157,32 @@ class TransformerEncoder(Layer):
         self.d_v = d_v
         self.n_heads = n_heads
         self.ff_dim = ff_dim
-        self.attn_heads = list()
         self.dropout_rate = dropout
 
     def build(self, input_shape):
         self.attn_multi = MultiAttention(self.d_k, self.d_v, self.n_heads)
         self.attn_dropout = Dropout(self.dropout_rate)
-        self.attn_normalize = LayerNormalization(input_shape=input_shape, epsilon=1e-6)
+        self.attn_normalize = LayerNormalization(input_shape=input_shape, epsilon=1e-6, dtype='float32')
 
-        self.ff_conv1D_1 = Conv1D(filters=self.ff_dim, kernel_size=1, activation='relu')
+        # Dense on the last axis is the same as Conv1D(kernel_size=1), without the convolution path
+        self.ff_1 = Dense(self.ff_dim, activation='relu')
         # input_shape[0]=(batch, seq_len, 6), input_shape[0][-1] = 6
-        self.ff_conv1D_2 = Conv1D(filters=input_shape[0][-1], kernel_size=1) 
+        self.ff_2 = Dense(input_shape[0][-1])
         self.ff_dropout = Dropout(self.dropout_rate)
-        self.ff_normalize = LayerNormalization(input_shape=input_shape, epsilon=1e-6)    
+        self.ff_normalize = LayerNormalization(input_shape=input_shape, epsilon=1e-6, dtype='float32')    
     
     def call(self, inputs): # inputs = (in_seq, in_seq, in_seq)
         attn_layer = self.attn_multi(inputs)
         attn_layer = self.attn_dropout(attn_layer)
-        attn_layer = self.attn_normalize(inputs[0] + attn_layer)
+        # Normalize in float32, float16 variances can underflow for small returns
+        attn_layer = self.attn_normalize(tf.cast(inputs[0] + attn_layer, tf.float32))
+        attn_layer = tf.cast(attn_layer, self.compute_dtype)
 
-        ff_layer = self.ff_conv1D_1(attn_layer)
-        ff_layer = self.ff_conv1D_2(ff_layer)
+        ff_layer = self.ff_1(attn_layer)
+        ff_layer = self.ff_2(ff_layer)
         ff_layer = self.ff_dropout(ff_layer)
-        ff_layer = self.ff_normalize(inputs[0] + ff_layer)
+        ff_layer = self.ff_normalize(tf.cast(inputs[0] + ff_layer, tf.float32))
+        ff_layer = tf.cast(ff_layer, self.compute_dtype)
         return ff_layer 
 
     def get_config(self): # Needed for saving and loading model with custom layer
@@ -175,7 +192,6 @@ class TransformerEncoder(Layer):
             'd_v': self.d_v,
             'n_heads': self.n_heads,
             'ff_dim': self.ff_dim,
-            'attn_heads': self.attn_heads,
             'dropout_rate': self.dropout_rate
         })
         return config
@@ -196,14 +212,19 @@ def create_model():
     x = attn_layer1((x, x, x))
     x = attn_layer2((x, x, x))
     x = attn_layer3((x, x, x))
+    # channels_first on purpose: average the 6 features of each timestep and let Dense(64) weigh the 128 timesteps,
+    # consecutive windows share 127 rows so averaging over time leaves almost nothing to tell them apart
     x = GlobalAveragePooling1D(data_format='channels_first')(x)
     x = Dropout(0.1)(x)
     x = Dense(64, activation='relu')(x)
     x = Dropout(0.1)(x)
-    out = Dense(1, activation='linear')(x)
+    out = Dense(1, activation='linear', dtype='float32')(x) # Keep the output (and loss) in float32
 
     model = Model(inputs=in_seq, outputs=out)
-    model.compile(loss='mse', optimizer='adam', metrics=['mae', 'mape'])
+    optimizer = tf.keras.optimizers.Adam()
+    if tf.keras.mixed_precision.global_policy().name == 'mixed_float16':
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    model.compile(loss='mse', optimizer=optimizer, metrics=['mae', 'mape'], jit_compile=True)
     return model
 
 #############################################################################
@@ -229,15 +250,17 @@ def training(IBM_path: str):
     ###############################################################################
     '''Create indexes to split dataset'''
 
-    times = sorted(df.index.values)
-    last_10pct = sorted(df.index.values)[-int(0.1*len(times))] # Last 10% of series
-    last_20pct = sorted(df.index.values)[-int(0.2*len(times))] # Last 20% of series
+    times = df.index.values # Already in order, dropna keeps the row order
+    last_10pct = times[-int(0.1*len(times))] # Last 10% of series
+    last_20pct = times[-int(0.2*len(times))] # Last 20% of series
 
     ###############################################################################
     '''Normalize price columns'''
     #
-    min_return = min(df[(df.index < last_20pct)][['Open', 'High', 'Low', 'Close']].min(axis=0))
-    max_return = max(df[(df.index < last_20pct)][['Open', 'High', 'Low', 'Close']].max(axis=0))
+    train_slice = df.loc[df.index < last_20pct, ['Open', 'High', 'Low', 'Close']].values
+    min_return = train_slice.min()
+    max_return = train_slice.max()
+    np.savez('stock_stats.npz', min_return=min_return, max_return=max_return) # Reused by testing
 
     # Min-max normalize price columns (0-1 range)
     df['Open'] = (df['Open'] - min_return) / (max_return - min_return)
@@ -253,9 +276,9 @@ def training(IBM_path: str):
     df_test = df[(df.index >= last_10pct)]
 
     # Convert pandas columns into arrays
-    train_data = df_train.values
-    val_data = df_val.values
-    test_data = df_test.values
+    train_data = df_train.values.astype(np.float32)
+    val_data = df_val.values.astype(np.float32)
+    test_data = df_test.values.astype(np.float32)
     print('Training data shape: {}'.format(train_data.shape))
     print('Validation data shape: {}'.format(val_data.shape))
     print('Test data shape: {}'.format(test_data.shape))
@@ -264,29 +287,21 @@ def training(IBM_path: str):
     ###############################################################################
 
     # Training data
-    X_train, y_train = [], []
-    for i in range(seq_len, len(train_data)):
-        X_train.append(train_data[i-seq_len:i]) # Chunks of training data with a length of 128 df-rows
-        y_train.append(train_data[:, 3][i]) #Value of 4th column (Close Price) of df-row 128+1
-    X_train, y_train = np.array(X_train), np.array(y_train)
+    # Chunks of training data with a length of 128 df-rows, target is the 4th column (Close Price) of df-row 128+1
+    X_train = np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(train_data, (seq_len, train_data.shape[1]))[:-1, 0])
+    y_train = train_data[seq_len:, 3]
 
     ###############################################################################
 
     # Validation data
-    X_val, y_val = [], []
-    for i in range(seq_len, len(val_data)):
-        X_val.append(val_data[i-seq_len:i])
-        y_val.append(val_data[:, 3][i])
-    X_val, y_val = np.array(X_val), np.array(y_val)
+    X_val = np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(val_data, (seq_len, val_data.shape[1]))[:-1, 0])
+    y_val = val_data[seq_len:, 3]
 
     ###############################################################################
 
     # Test data
-    X_test, y_test = [], []
-    for i in range(seq_len, len(test_data)):
-        X_test.append(test_data[i-seq_len:i])
-        y_test.append(test_data[:, 3][i])    
-    X_test, y_test = np.array(X_test), np.array(y_test)
+    X_test = np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(test_data, (seq_len, test_data.shape[1]))[:-1, 0])
+    y_test = test_data[seq_len:, 3]
 
     print('Training set shape', X_train.shape, y_train.shape)
     print('Validation set shape', X_val.shape, y_val.shape)
@@ -294,6 +309,10 @@ def training(IBM_path: str):
 
     ###############################################################################
 
+    # Train the matmuls in float16 on GPUs (Tensor Cores) while keeping variables in float32
+    if tf.config.list_physical_devices('GPU'):
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+
     model = create_model()
     model.summary()
 
@@ -302,19 +321,23 @@ def training(IBM_path: str):
                                                 save_best_only=True, 
                                                 verbose=1)
 
-    history = model.fit(X_train, y_train, 
-                        batch_size=batch_size, 
+    # Cache the batches in memory and prepare the next one while the current step runs
+    train_ds = tf.data.Dataset.from_tensor_slices((X_train, y_train)).cache() \
+        .shuffle(len(X_train)).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    val_ds = tf.data.Dataset.from_tensor_slices((X_val, y_val)).cache() \
+        .batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+    history = model.fit(train_ds, 
                         epochs=50,
                         callbacks=[callback],
-                        validation_data=(X_val, y_val))  
+                        validation_data=val_ds)  
 
-    model = tf.keras.models.load_model('/content/Transformer+TimeEmbedding.hdf5',
+    model = tf.keras.models.load_model('Transformer+TimeEmbedding.hdf5',
                                     custom_objects={'Time2Vector': Time2Vector, 
-                                                    'SingleAttention': SingleAttention,
                                                     'MultiAttention': MultiAttention,
                                                     'TransformerEncoder': TransformerEncoder})
 
-    model.save('stock.h5')
+    model.save('stock.h5', include_optimizer=False) # Only used for inference
 
     ###############################################################################
 
@@ -335,70 +358,82 @@ def training(IBM_path: str):
     print('Validation Data - Loss: {:.4f}, MAE: {:.4f}, MAPE: {:.4f}'.format(val_eval[0], val_eval[1], val_eval[2]))
     print('Test Data - Loss: {:.4f}, MAE: {:.4f}, MAPE: {:.4f}'.format(test_eval[0], test_eval[1], test_eval[2]))
 
+    # A model that failed to train does no better than always predicting the mean training target
+    const_val_loss = np.mean((y_val - y_train.mean()) ** 2)
+    const_test_loss = np.mean((y_test - y_train.mean()) ** 2)
+    print('Constant baseline - Validation Loss: {:.4f}, Test Loss: {:.4f}'.format(const_val_loss, const_test_loss))
+
+    # Back to float32 so inference in this process matches a fresh load_model()
+    tf.keras.mixed_precision.set_global_policy('float32')
+
 #############################################################################
 
-def load_model():
-    model = tf.keras.models.load_model(
-        'stock.h5',
-        custom_objects={
-            'Time2Vector': Time2Vector, 
-            'SingleAttention': SingleAttention,
-            'MultiAttention': MultiAttention,
-            'TransformerEncoder': TransformerEncoder
-        }
-    )
-    return model
+_MODEL_CACHE = None
 
-def testing(df_input):
-    # Apply moving average with a window of 10 days to all columns
-    df = df_input[['Open', 'High', 'Low', 'Close']].rolling(10).mean()
+def load_model():
+    '''Load stock.h5 once and reuse it on later calls'''
+    global _MODEL_CACHE
+    if _MODEL_CACHE is None:
+        _MODEL_CACHE = tf.keras.models.load_model(
+            'stock.h5',
+            custom_objects={
+                'Time2Vector': Time2Vector, 
+                'MultiAttention': MultiAttention,
+                'TransformerEncoder': TransformerEncoder
+            }
+        )
+    return _MODEL_CACHE
 
-    # Drop all rows with NaN values
-    df.dropna(how='any', axis=0, inplace=True)
+_INFER_CACHE = None
 
-    '''Calculate percentage change'''
+def load_infer():
+    '''XLA-compiled forward pass of the loaded model, without the overhead of model.predict'''
+    global _INFER_CACHE
+    if _INFER_CACHE is None:
+        model = load_model()
 
-    df['Open'] = df['Open'].pct_change() # Create arithmetic returns column
-    df['High'] = df['High'].pct_change() # Create arithmetic returns column
-    df['Low'] = df['Low'].pct_change() # Create arithmetic returns column
-    df['Close'] = df['Close'].pct_change() # Create arithmetic returns column
+        # Fixed input signature so varying batch sizes do not retrace
+        @tf.function(jit_compile=True, input_signature=[tf.TensorSpec((None, seq_len, 4), tf.float32)])
+        def infer(x):
+            return model(x, training=False)
 
-    df.dropna(how='any', axis=0, inplace=True) # Drop all rows with NaN values
+        _INFER_CACHE = infer
+    return _INFER_CACHE
 
-    ###############################################################################
-    '''Normalize price columns'''
-    #
-    min_return = min(df[['Open', 'High', 'Low', 'Close']].min(axis=0))
-    max_return = max(df[['Open', 'High', 'Low', 'Close']].max(axis=0))
+def compute_returns(prices, window=10):
+    '''Moving average with a window of 10 days followed by percentage change, shape = (len(prices) - window, 4)'''
+    csum = np.concatenate([np.zeros((1, prices.shape[1])), np.cumsum(prices, axis=0, dtype=np.float64)])
+    rolling_mean = (csum[window:] - csum[:-window]) / window
+    return rolling_mean[1:] / rolling_mean[:-1] - 1 # Create arithmetic returns
 
-    # Min-max normalize price columns (0-1 range)
-    df['Open'] = (df['Open'] - min_return) / (max_return - min_return)
-    df['High'] = (df['High'] - min_return) / (max_return - min_return)
-    df['Low'] = (df['Low'] - min_return) / (max_return - min_return)
-    df['Close'] = (df['Close'] - min_return) / (max_return - min_return)
+_STATS_CACHE = None
 
-    ###############################################################################
-    '''Create training, validation and test split'''
+def load_stats():
+    '''Load the (min_return, max_return) used to normalize the training data once'''
+    global _STATS_CACHE
+    if _STATS_CACHE is None:
+        stats = np.load('stock_stats.npz')
+        _STATS_CACHE = (float(stats['min_return']), float(stats['max_return']))
+    return _STATS_CACHE
 
-    df_train = df  # Training data
+def testing(df_input):
+    '''Predict from the history in df_input, only its last seq_len + 11 rows are needed for one window'''
+    prices = df_input.iloc[-(seq_len + 11):][['Open', 'High', 'Low', 'Close']].values.astype(np.float64)
 
-    # Convert pandas columns into arrays
-    train_data = df_train.values
-    print('Training data shape: {}'.format(train_data.shape))
+    '''Calculate moving average and percentage change'''
+    returns = compute_returns(prices)
 
-    ###############################################################################
-    ###############################################################################
+    # Min-max normalize price columns (0-1 range) with the statistics of training
+    min_return, max_return = load_stats()
+    returns = (returns - min_return) / (max_return - min_return)
 
-    # Training data
-    X_train = []
-    for i in range(seq_len, len(train_data)):
-        X_train.append(train_data[i-seq_len:i]) # Chunks of training data with a length of 128 df-rows
-    X_train = np.array(X_train)
+    # The seq_len rows before the newest one, same window as the main path
+    window = returns[-seq_len - 1:-1].astype(np.float32)
 
-    model = load_model()
-    train_pred = model.predict(X_train)
+    infer = load_infer()
+    pred = infer(tf.constant(window[None])).numpy()
 
-    return train_pred[-1][0]
+    return pred[0][0]
 
 #############################################################################
 
@@ -421,26 +456,37 @@ if __name__ == "__main__":
     testing_path = args.testing
     df_test = pd.read_csv(testing_path, delimiter=',', header=None, names=['Open', 'High', 'Low', 'Close'])
 
+    ###############################################################################
+    '''Build the windows for all testing days at once'''
+
+    # Moving average and returns only look backwards, so computing them on the whole
+    # series gives the same rows testing() would see on the growing history
+    returns = compute_returns(np.concatenate([df_train.values, df_test.values]))
+
+    # Normalize with the statistics saved by training()
+    min_return, max_return = load_stats()
+    returns = ((returns - min_return) / (max_return - min_return)).astype(np.float32)
+
+    # Like testing(), the window of each day is the seq_len rows before the newest one
+    windows = np.lib.stride_tricks.sliding_window_view(returns, (seq_len, 4))[:, 0]
+    first = len(df_train) - 10 - seq_len - 1 # Returns of the training history have len(df_train) - 10 rows
+    X_test = windows[first:first + len(df_test) - 1]
+
+    infer = load_infer()
+    preds = infer(tf.constant(X_test)).numpy()[:, 0]
+
+    '''Turn the predictions into actions'''
+    # We will perform your action as the open price in the next day.
+    up = np.diff(preds, prepend=0) > 0 # Prediction rises compared to the day before
+    actions = np.zeros(len(preds), dtype=np.int8)
+    unit = 0
+    for i in range(len(up)):
+        if up[i] and unit == 0:
+            actions[i] = 1
+            unit += 1
+        elif not up[i] and unit == 1:
+            actions[i] = -1
+            unit -= 1
+
     with open(args.output, "w") as output_file:
-        prev_pred = 0
-        unit = 0
-        for i, row in df_test.iterrows(): # read a row of testing data at one time
-            if (i == len(df_test) - 1):
-                break
-            # We will perform your action as the open price in the next day.
-            pred = testing(df_train)
-            if (pred > prev_pred):
-                if (unit == 0):
-                    output_file.write('1\n')
-                    unit += 1
-                else:
-                    output_file.write('0\n')
-            else:
-                if (unit == 1):
-                    output_file.write('-1\n')
-                    unit -= 1
-                else:
-                    output_file.write('0\n')
-            
-            df_train = df_train.append(row)
-            prev_pred = pred
+        output_file.write(''.join('{}\n'.format(action) for action in actions))